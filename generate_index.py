@@ -1,11 +1,27 @@
+import boto3
 import s3fs
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+import gzip
+import io
 import json
 import os
+import re
+import sys
+import time
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 import logging
 import hashlib
 
-from typing import Callable
+from typing import Callable, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DOC_TEMPLATE = """
 <!DOCTYPE html>
@@ -17,12 +33,21 @@ DOC_TEMPLATE = """
 </html>
 """
 
+# kept for reference/reuse; the hot loop in `generate_index` builds the
+# equivalent links with f-strings to skip the str.format machinery
 LINK_TEMPLATE = """<a href="{wheel_relative_path}">{wheel_name}</a><br/>"""
 
 LINK_TEMPLATE_SHA = (
     """<a href="{wheel_relative_path}#{sha256_digest}">{wheel_name}</a><br/>"""
 )
 
+# <bucket_name>/<git ref>/<wheel name>.whl
+_PATH_RE = re.compile(r"^[^/]+/([^/]+)/([^/]+\.whl)$")
+
+# paths made only of these characters come out of quote() unchanged
+# (quote's default safe set: unreserved characters plus "/")
+_SAFE_PATH_RE = re.compile(r"\A[A-Za-z0-9._~/-]+\Z")
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.DEBUG if os.getenv("INDEXER_DEBUG") else logging.INFO,
@@ -31,9 +56,47 @@ logging.basicConfig(
 logger = logging.getLogger("indexer")
 
 
+def _json_loads(data: bytes):
+    """orjson is noticeably faster on large key lists, but optional"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    """Write `data` to `path` without readers ever seeing partial content
+
+    Writing to a temp file and `os.replace`-ing it into place keeps
+    concurrent readers on either the old or the new complete file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp_path, path)
+
+
+class _HashingWriter:
+    """File-like object forwarding every write into a hash object"""
+
+    def __init__(self, hasher):
+        self._hasher = hasher
+
+    def write(self, chunk: bytes) -> int:
+        self._hasher.update(chunk)
+        return len(chunk)
+
+
 class S3Indexer:
-    hash_bs: int = 2 << 22  # 8MiB, tweak as needed
+    hash_bs: int = 2 << 23  # 16MiB, tweak as needed
     digest_suffix: str = ".sha256sum"
+    cache_file: str = "bucket_dump.json"
+    digest_cache_file: str = "digest_cache.json"
 
     def __init__(
         self,
@@ -41,6 +104,7 @@ class S3Indexer:
         module_name: str = "vllm",
         with_digests: bool = True,
         dry_run: bool = False,
+        refresh: bool = False,
     ):
         """
         Arguments:
@@ -48,24 +112,42 @@ class S3Indexer:
             - absolute_path: use absolute path for wheel links
             - compute_digest: compute sha256 digest for every indexed file
             - write_digest: write sha256 digest back to the bucket
+            - refresh: ignore the on-disk listing cache and re-list the bucket
         """
         self.bucket_name = bucket_name
         self.module_name = module_name
         self.fs = s3fs.S3FileSystem()
         self.with_digests = with_digests
         self._dry_run = dry_run
+        self._refresh = refresh
+        # listing cache TTL in seconds, <= 0 disables caching
+        self.list_ttl = int(os.getenv("INDEXER_LIST_TTL", "300"))
+        self._s3_client = None
+        self._pending_digest_writes: list[tuple[str, str]] = []
+        self._objects: list[dict] | None = None
+        # don't re-upload indexes whose content matches what's in the bucket
+        self._skip_unchanged = True
+
+    @property
+    def _s3(self):
+        """boto3 client pointing at the same endpoint as `self.fs`"""
+        if self._s3_client is None:
+            self._s3_client = boto3.client("s3", endpoint_url=self.fs.endpoint_url)
+        return self._s3_client
 
     def get_digest(self, key: str) -> str:
         digest_file = f"{key}{self.digest_suffix}"
         logger.debug("Getting digest: %s", digest_file)
 
-        if not self.fs.exists(digest_file):
+        try:
+            with self.fs.open(digest_file, "r") as fh:
+                digest = fh.read()
+        except (FileNotFoundError, ValueError) as exc:
+            # no up-front exists() probe: that would cost an extra HEAD.
+            # s3fs raises ValueError for non key-like paths
             raise FileNotFoundError(
                 f"sha256 digest does not exist: {digest_file} is missing"
-            )
-
-        with self.fs.open(digest_file, "r") as fh:
-            digest = fh.read()
+            ) from exc
 
         return digest
 
@@ -83,14 +165,45 @@ class S3Indexer:
         If `compare == True`, raises `KeyError` if the key is missing from the bucket,
         if the values do not match, raises `ValueError`.
         """
-        sha256_hash = hashlib.sha256()
-
         logger.debug("Computing sha256 digest for %s", key)
-        with self.fs.open(key, "rb") as fh:
-            for byte_block in iter(lambda: fh.read(self.hash_bs), b""):
-                sha256_hash.update(byte_block)
-
-        digest = sha256_hash.hexdigest()
+        bucket, _, obj_key = key.partition("/")
+        try:
+            size = self._s3.head_object(Bucket=bucket, Key=obj_key)["ContentLength"]
+        except ClientError as exc:
+            code = exc.response.get("Error", {}).get("Code")
+            if code in ("404", "NoSuchKey", "NoSuchBucket"):
+                raise FileNotFoundError(key) from exc
+            raise
+
+        if size >= self.hash_bs:
+            # large objects: concurrent ranged GETs, hashed as the parts
+            # stream back in order
+            sha256_hash = hashlib.sha256()
+            self._s3.download_fileobj(
+                bucket,
+                obj_key,
+                _HashingWriter(sha256_hash),
+                Config=TransferConfig(
+                    multipart_threshold=self.hash_bs,
+                    multipart_chunksize=16 << 20,
+                    max_concurrency=8,
+                ),
+            )
+            digest = sha256_hash.hexdigest()
+        else:
+            # background cache: fsspec prefetches the next block on a
+            # worker thread while the current one is being hashed
+            with self.fs.open(
+                key, "rb", block_size=self.hash_bs, cache_type="background"
+            ) as fh:
+                if sys.version_info >= (3, 11):
+                    # read/update loop runs in C with the GIL released
+                    digest = hashlib.file_digest(fh, "sha256").hexdigest()
+                else:
+                    sha256_hash = hashlib.sha256()
+                    for byte_block in iter(lambda: fh.read(self.hash_bs), b""):
+                        sha256_hash.update(byte_block)
+                    digest = sha256_hash.hexdigest()
         digest_file = f"{key}{self.digest_suffix}"
 
         if compare:
@@ -99,22 +212,206 @@ class S3Indexer:
             if current_digest != digest:
                 raise ValueError(f"sha256 digest does not match for {digest_file}")
 
-        if write and self._dry_run:
-            logger.warning("Dry run: not writing digests back to S3")
-        elif write:
-            with self.fs.open(digest_file, "w") as fh:
-                logger.debug("Wrote digest to %s", digest_file)
-                fh.write(digest)
+        if write:
+            # queued rather than written here: flush_digests() pushes all
+            # pending digests in one parallel pass
+            self._pending_digest_writes.append((digest_file, digest))
 
         return digest
 
-    def _get_files(self, filter_fn: Callable | None = None) -> list[str]:
-        return list(
-            filter(
-                filter_fn,
-                self.fs.find(f"s3://{self.bucket_name}/"),
+    def _put_digest(self, digest_file: str, digest: str) -> None:
+        bucket, _, obj_key = digest_file.partition("/")
+        try:
+            # conditional PUT: one round-trip instead of exists + write,
+            # and concurrent runs can't clobber each other
+            self._s3.put_object(
+                Bucket=bucket, Key=obj_key, Body=digest.encode(), IfNoneMatch="*"
             )
-        )
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") == "PreconditionFailed":
+                logger.debug("Digest already exists, not writing: %s", digest_file)
+                return
+            raise
+        logger.debug("Wrote digest to %s", digest_file)
+
+    def flush_digests(self) -> None:
+        """Write digests queued by `compute_digest` back to the bucket
+
+        PUTs are batched through a thread pool so write-back latency does
+        not serialize into the digest-computation path.
+        """
+        pending, self._pending_digest_writes = self._pending_digest_writes, []
+        if not pending:
+            return
+
+        if self._dry_run:
+            logger.warning("Dry run: not writing digests back to S3")
+            return
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(lambda item: self._put_digest(*item), pending))
+
+    def fetch_digests(self, keys: list[str]) -> dict[str, str]:
+        """Fetch existing digests for the given wheel keys concurrently
+
+        Each digest object is only 64 bytes but costs a full round-trip,
+        so a wide pool of plain GETs amortizes the latency. Keys whose
+        digest turns out to be missing (deleted since the listing, or a
+        stale cached listing) are left out of the result rather than
+        failing the whole batch; callers fall back to computing them.
+        """
+
+        def fetch(key: str) -> str | None:
+            bucket, _, obj_key = key.partition("/")
+            try:
+                obj = self._s3.get_object(
+                    Bucket=bucket, Key=f"{obj_key}{self.digest_suffix}"
+                )
+            except ClientError as exc:
+                code = exc.response.get("Error", {}).get("Code")
+                if code in ("404", "NoSuchKey", "NoSuchBucket"):
+                    logger.warning("Digest listed but missing: %s", key)
+                    return None
+                raise
+            return obj["Body"].read().decode().strip()
+
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            return {
+                key: digest
+                for key, digest in zip(keys, executor.map(fetch, keys))
+                if digest is not None
+            }
+
+    def _load_digest_cache(self) -> dict:
+        try:
+            with open(self.digest_cache_file, "rb") as fh:
+                return _json_loads(fh.read())
+        except (OSError, ValueError):
+            return {}
+
+    def _save_digest_cache(self, cache: dict) -> None:
+        _atomic_write(self.digest_cache_file, _json_dumps(cache))
+        logger.debug("Cached %d digests to %s", len(cache), self.digest_cache_file)
+
+    def _gather_digests(
+        self, wheels: list[str], existing_digests: set[str], etags: dict[str, str]
+    ) -> dict[str, str]:
+        """Fetch (or compute) digests for the given wheels concurrently.
+
+        `existing_digests` comes from the bucket listing, so membership
+        checks are free. Wheels are immutable once uploaded, so a wheel
+        whose ETag matches the entry in the local digest cache reuses the
+        cached digest with zero network traffic; the remaining wheels with
+        a digest in the bucket go through the bulk fetch, and only wheels
+        without one get downloaded and hashed.
+        """
+        cache_enabled = self.list_ttl > 0
+        cached: dict = self._load_digest_cache() if cache_enabled else {}
+
+        digests: dict[str, str] = {}
+        to_fetch: list[str] = []
+        missing: list[str] = []
+        for key in wheels:
+            if f"{key}{self.digest_suffix}" not in existing_digests:
+                missing.append(key)
+                continue
+            entry = cached.get(key)
+            if entry and entry[0] == etags.get(key):
+                digests[key] = entry[1]
+            else:
+                to_fetch.append(key)
+
+        if digests:
+            logger.debug("Reusing %d cached digests", len(digests))
+        digests.update(self.fetch_digests(to_fetch))
+        # digests that vanished between LIST and GET get recomputed
+        missing.extend(key for key in to_fetch if key not in digests)
+
+        max_workers = int(os.getenv("INDEXER_HASH_WORKERS", "32"))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            digests.update(zip(missing, executor.map(self.compute_digest, missing)))
+
+        if cache_enabled:
+            self._save_digest_cache(
+                {
+                    key: [etags[key], digest]
+                    for key, digest in digests.items()
+                    if key in etags
+                }
+            )
+
+        return digests
+
+    def _iter_objects(self) -> Iterator[dict]:
+        """Yield all objects in the bucket using bulk LIST calls.
+
+        A single pass through the `list_objects_v2` paginator (1000 keys
+        per request) is much cheaper than the recursive walk `fs.find`
+        performs. Each entry carries the key (bucket-prefixed, matching
+        the paths used throughout) and the object's ETag.
+        """
+        paginator = self._s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name):
+            for obj in page.get("Contents", ()):
+                yield {
+                    "Key": f"{self.bucket_name}/{obj['Key']}",
+                    "ETag": obj["ETag"].strip('"'),
+                }
+
+    def _get_objects(self) -> list[dict]:
+        """Return all objects in the bucket, using the on-disk cache when fresh.
+
+        The listing is cached to `self.cache_file` for `self.list_ttl`
+        seconds so that repeated runs against a slowly-changing bucket
+        skip the LIST traffic entirely. The cache is replaced atomically
+        and an unreadable cache falls back to re-listing, so parallel
+        jobs sharing a working directory do not race.
+
+        The result is also memoized in memory, so every consumer within
+        a run shares one listing.
+        """
+        if self._objects is not None:
+            return self._objects
+
+        if self.list_ttl > 0 and not self._refresh:
+            try:
+                age = time.time() - os.path.getmtime(self.cache_file)
+            except OSError:
+                age = None
+
+            if age is not None and age < self.list_ttl:
+                try:
+                    with open(self.cache_file, "rb") as fh:
+                        objects = _json_loads(fh.read())
+                except (OSError, ValueError):
+                    logger.warning(
+                        "Unreadable listing cache, re-listing: %s", self.cache_file
+                    )
+                    objects = None
+                else:
+                    logger.debug("Using cached bucket listing from %s", self.cache_file)
+                # ignore caches in the old key-list format
+                if objects and not isinstance(objects[0], dict):
+                    objects = None
+                if objects is not None:
+                    self._objects = objects
+                    return self._objects
+
+        objects = list(self._iter_objects())
+
+        if self.list_ttl > 0:
+            _atomic_write(self.cache_file, _json_dumps(objects))
+            logger.debug("Cached bucket listing to %s", self.cache_file)
+            self._refresh = False
+
+        self._objects = objects
+        return objects
+
+    def _get_keys(self) -> list[str]:
+        return [obj["Key"] for obj in self._get_objects()]
+
+    def _get_files(self, filter_fn: Callable | None = None) -> list[str]:
+        return list(filter(filter_fn, self._get_keys()))
 
     def get_all_wheels(self) -> list[str]:
         """returns a list of paths of wheels relative to the s3 bucket"""
@@ -139,55 +436,72 @@ class S3Indexer:
         - nightlies_index is an html index of all the nightly wheels in the bucket (s3://<bucket>/nightly/<module name>/index.html)
         - git_refs_index is a dict containing html indexes for each git ref (s3://<bucket>/<git ref>/<module name>/index.html)
         """
-        wheels = self.get_all_wheels()
-
-        links: list[str] = []
-        nightlies_links: list[str] = []
-        git_refs_indexes: dict[str, str] = {}
+        # a single listing pass feeds both the wheel list and the set of
+        # already-present digest files
+        logger.info("Indexing bucket at s3://%s", self.bucket_name)
+        objects = self._get_objects()
+        keys = [obj["Key"] for obj in objects]
+        wheels = [key for key in keys if key.endswith(".whl")]
+        existing_digests = {key for key in keys if key.endswith(self.digest_suffix)}
+
+        # links are written straight into string buffers instead of being
+        # collected in lists and joined: one copy of the text, not three
+        links_buf = io.StringIO()
+        nightlies_buf = io.StringIO()
+        git_ref_links: dict[str, list[str]] = defaultdict(list)
         if self._dry_run:
             logger.warning("Making link paths absolute")
 
+        digests: dict[str, str] = {}
+        if self.with_digests:
+            etags = {obj["Key"]: obj["ETag"] for obj in objects}
+            digests = self._gather_digests(wheels, existing_digests, etags)
+            self.flush_digests()
+
         for wheel_path in wheels:
             logger.debug("Processing wheel_path=%s", wheel_path)
-            try:
-                _, git_ref, wheel_name = wheel_path.split("/")
-            except ValueError:
+            match = _PATH_RE.match(wheel_path)
+            if not match:
                 logger.error(
                     "Couldn't extract bucket_name, git_ref and wheel name from wheel_relpath=%s",
                     wheel_path,
                 )
+                continue
+            git_ref, wheel_name = match.groups()
 
-            wheel_relpath = quote(f"{git_ref}/{wheel_name}")
+            wheel_relpath = f"{git_ref}/{wheel_name}"
+            if not _SAFE_PATH_RE.match(wheel_relpath):
+                wheel_relpath = quote(wheel_relpath)
             if self._dry_run:
                 wheel_relpath = (  # FIXME: this is hardcoded for now
                     f"https://vllm-wheels.s3.us-west-2.amazonaws.com/{wheel_relpath}"
                 )
 
             if self.with_digests:
-                try:
-                    digest = self.get_digest(wheel_path)
-                except FileNotFoundError:
-                    digest = self.compute_digest(wheel_path)
-
-                link = LINK_TEMPLATE_SHA.format(
-                    wheel_relative_path=wheel_relpath,
-                    wheel_name=wheel_name,
-                    sha256_digest=digest,
-                )
+                digest = digests[wheel_path]
+                link = f'<a href="{wheel_relpath}#{digest}">{wheel_name}</a><br/>'
             else:
-                link = LINK_TEMPLATE.format(
-                    wheel_relative_path=wheel_relpath,
-                    wheel_name=wheel_name,
-                )
+                link = f'<a href="{wheel_relpath}">{wheel_name}</a><br/>'
 
             if "nightly" in wheel_path:
-                nightlies_links.append(link)
+                if nightlies_buf.tell():
+                    nightlies_buf.write("\n")
+                nightlies_buf.write(link)
             else:
-                git_refs_indexes[git_ref] = DOC_TEMPLATE.format(links="\n".join([link]))
-                links.append(link)
-
-        index = DOC_TEMPLATE.format(links="\n".join(links))
-        nightlies_index = DOC_TEMPLATE.format(links="\n".join(nightlies_links))
+                git_ref_links[git_ref].append(link)
+                if links_buf.tell():
+                    links_buf.write("\n")
+                links_buf.write(link)
+
+        index = DOC_TEMPLATE.format(links=links_buf.getvalue())
+        nightlies_index = DOC_TEMPLATE.format(links=nightlies_buf.getvalue())
+        # render each ref's index once, with all of its wheels: formatting
+        # inside the loop overwrote the entry on every wheel, so only the
+        # last wheel per ref ever made it into the output
+        git_refs_indexes = {
+            git_ref: DOC_TEMPLATE.format(links="\n".join(ref_links))
+            for git_ref, ref_links in git_ref_links.items()
+        }
 
         return (
             index,
@@ -206,33 +520,69 @@ class S3Indexer:
             key = f"{self.module_name}/index.html"
 
         if self._dry_run:
-            index_path = os.path.join("index_test", key)
-            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            index_path = Path("index_test", key)
         else:
             index_path = f"s3://{self.bucket_name}/{key}"
         try:
             if self._dry_run:
-                with open(index_path, "w") as fh:
-                    fh.write(contents)
+                index_path.parent.mkdir(parents=True, exist_ok=True)
+                index_path.write_text(contents, encoding="utf-8")
             else:
-                with self.fs.open(f"s3://{index_path}", "w") as fh:
-                    fh.write(contents)
+                # indexes are highly repetitive markup, ~8x smaller
+                # compressed; pip and browsers decompress transparently.
+                # mtime=0 keeps the output deterministic so the
+                # unchanged-content ETag compare still works
+                body = gzip.compress(contents.encode("utf-8"), compresslevel=6, mtime=0)
+                if self._skip_unchanged and not self._index_changed(key, body):
+                    logger.debug("Index unchanged, not uploading: %s", key)
+                    return
+                # put_object skips the multipart-upload setup s3fs does
+                # even for these small files
+                self._s3.put_object(
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    Body=body,
+                    ContentType="text/html",
+                    ContentEncoding="gzip",
+                )
         except:  # noqa: E722
             logger.exception("Failed to write index to=%s", index_path)
 
+    def _index_changed(self, key: str, body: bytes) -> bool:
+        """Compare the object's ETag against the md5 of the new contents
+
+        Indexes are uploaded with a single put_object, so the stored ETag
+        is the plain md5 of the body.
+        """
+        try:
+            resp = self._s3.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError:
+            return True
+        return resp["ETag"].strip('"') != hashlib.md5(body).hexdigest()
+
     def run(self):
         index_html, nightlies_index, git_refs_indexes = self.generate_index()
 
-        self.write_index(contents=index_html)
-        self.write_index(contents=nightlies_index, prefix="nightly")
-        for git_ref, index in git_refs_indexes.items():
-            self.write_index(contents=index, prefix=git_ref)
+        # one index per git ref plus the two top-level ones: upload them
+        # concurrently instead of paying one PUT round-trip at a time
+        tasks = [(index_html, ""), (nightlies_index, "nightly")]
+        tasks.extend((index, git_ref) for git_ref, index in git_refs_indexes.items())
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(
+                executor.map(
+                    lambda task: self.write_index(contents=task[0], prefix=task[1]),
+                    tasks,
+                )
+            )
 
 
 def main():
     dry_run = os.getenv("INDEXER_DRY_RUN", "True").lower() != "false"
+    refresh = os.getenv("INDEXER_REFRESH", "False").lower() == "true"
     S3Indexer(
         dry_run=dry_run,
+        refresh=refresh,
     ).run()
 
     if dry_run:
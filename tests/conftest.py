@@ -73,13 +73,18 @@ def mocked_wheels_bucket(
             fh.write(wheel)  # write wheel name as dummy contents
 
 
-@pytest.fixture(scope="session")
+@pytest.fixture
 def indexer(mocked_wheels_bucket, s3_fs, bucket_name):
-    """Indexer pointing to the local moto instance"""
+    """Indexer pointing to the local moto instance
+
+    Function-scoped: the indexer memoizes the bucket listing, while the
+    mocked bucket changes between tests.
+    """
     indexer = S3Indexer(
         bucket_name=bucket_name,
         module_name="vllm",
     )
     indexer.fs = s3_fs
+    indexer.list_ttl = 0  # disable the on-disk listing cache
 
     yield indexer
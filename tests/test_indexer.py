@@ -1,7 +1,11 @@
+import gzip
+import json
 import os
+from pathlib import Path
 
 import pytest
 
+import generate_index
 from generate_index import S3Indexer
 
 
@@ -25,6 +29,9 @@ def test_compute_digest(indexer, wheels, s3_fs):
     assert not s3_fs.exists("s3://{wheels[0]}{indexer.digest_suffix}")
 
     digest = indexer.compute_digest(wheels[0], write=True)
+    assert not s3_fs.exists(f"s3://{wheels[0]}{indexer.digest_suffix}")
+
+    indexer.flush_digests()
 
     assert s3_fs.exists(f"s3://{wheels[0]}{indexer.digest_suffix}")
     with s3_fs.open(f"s3://{wheels[0]}{indexer.digest_suffix}", "r") as fh:
@@ -44,7 +51,8 @@ def test_write_index(indexer, prefix):
         path = f"{indexer.bucket_name}/{indexer.module_name}/index.html"
 
     with indexer.fs.open(path) as fh:
-        index_contents = fh.read().decode()
+        # indexes are uploaded gzip-compressed (Content-Encoding: gzip)
+        index_contents = gzip.decompress(fh.read()).decode()
 
     assert index_contents == "dummy"
 
@@ -108,6 +116,22 @@ def test_run(indexer, s3_fs, wheels):
         )
 
 
+def test_git_ref_indexes_contain_all_wheels(indexer, wheels):
+    """Every wheel of a ref must appear in that ref's index
+
+    Regression test: links used to overwrite each other, leaving only the
+    last wheel per ref in the output.
+    """
+    indexer.with_digests = False
+    _, _, git_refs_indexes = indexer.generate_index()
+
+    for wheel_path in wheels:
+        if "nightly" in wheel_path:
+            continue
+        _, git_ref, wheel_name = wheel_path.split("/")
+        assert wheel_name in git_refs_indexes[git_ref]
+
+
 def test_get_digest(indexer, wheels):
     digest = indexer.get_digest(wheels[0])
     assert digest == "3b200e5e581ab8da6bb4810c1277a30b361dfdbb2c109080a3b7a1f121bbcb06"
@@ -122,3 +146,166 @@ def test_get_all_digests(indexer, wheels):
             wheels,
         )
     )
+
+
+def test_listing_cache(tmp_path, monkeypatch, indexer, wheels, s3_fs, bucket_name):
+    monkeypatch.chdir(tmp_path)
+    indexer.list_ttl = 300
+
+    assert indexer.get_all_wheels() == wheels
+    assert os.path.exists(indexer.cache_file)
+    # second call within the same run is memoized
+    assert indexer.get_all_wheels() == wheels
+
+    # a fresh indexer within the TTL reads the cache instead of listing
+    cached = S3Indexer(bucket_name=bucket_name)
+    cached.fs = s3_fs
+    cached._s3_client = object()  # any listing attempt would blow up
+    assert cached.get_all_wheels() == wheels
+
+    # refresh=True re-lists even though the cache is fresh
+    refreshed = S3Indexer(bucket_name=bucket_name, refresh=True)
+    refreshed.fs = s3_fs
+    assert refreshed.get_all_wheels() == wheels
+
+
+def test_listing_cache_unreadable(tmp_path, monkeypatch, indexer, wheels):
+    monkeypatch.chdir(tmp_path)
+    indexer.list_ttl = 300
+
+    # corrupt cache: fall back to re-listing instead of crashing
+    Path(indexer.cache_file).write_bytes(b"not json")
+    assert indexer.get_all_wheels() == wheels
+
+
+def test_listing_cache_old_format(
+    tmp_path, monkeypatch, indexer, wheels, s3_fs, bucket_name
+):
+    monkeypatch.chdir(tmp_path)
+    indexer.list_ttl = 300
+
+    # caches in the old key-list format are ignored and rebuilt
+    Path(indexer.cache_file).write_text(json.dumps(wheels))
+    assert indexer.get_all_wheels() == wheels
+    assert isinstance(json.loads(Path(indexer.cache_file).read_text())[0], dict)
+
+
+def test_digest_cache(tmp_path, monkeypatch, indexer, s3_fs, bucket_name):
+    monkeypatch.chdir(tmp_path)
+    indexer.list_ttl = 300
+
+    index, nightlies_index, git_refs_indexes = indexer.generate_index()
+    assert os.path.exists(indexer.digest_cache_file)
+
+    # unchanged ETags: digests come from the local cache, zero GETs
+    cached = S3Indexer(bucket_name=bucket_name, refresh=True)
+    cached.fs = s3_fs
+
+    def no_fetch(keys):
+        assert not keys
+        return {}
+
+    monkeypatch.setattr(cached, "fetch_digests", no_fetch)
+    cached_index, _, _ = cached.generate_index()
+    assert cached_index == index
+
+
+def test_fetch_digests(indexer, wheels):
+    missing = f"{indexer.bucket_name}/nonexisting/whatever-1.0.whl"
+    digests = indexer.fetch_digests([wheels[0], missing])
+
+    # the missing digest is left out instead of failing the batch
+    assert digests == {
+        wheels[0]: "3b200e5e581ab8da6bb4810c1277a30b361dfdbb2c109080a3b7a1f121bbcb06"
+    }
+
+
+def test_compute_digest_multipart(indexer, wheels):
+    indexer.hash_bs = 1  # force the concurrent ranged-GET path
+    digest = indexer.compute_digest(wheels[0], write=False)
+    assert digest == "3b200e5e581ab8da6bb4810c1277a30b361dfdbb2c109080a3b7a1f121bbcb06"
+
+
+def test_compute_digest_pre_311(indexer, wheels, monkeypatch):
+    monkeypatch.setattr(generate_index.sys, "version_info", (3, 10, 0))
+    digest = indexer.compute_digest(wheels[0], write=False)
+    assert digest == "3b200e5e581ab8da6bb4810c1277a30b361dfdbb2c109080a3b7a1f121bbcb06"
+
+
+def test_put_digest_existing(indexer, s3_fs, wheels):
+    digest_file = f"{wheels[0]}{indexer.digest_suffix}"
+    with s3_fs.open(digest_file) as fh:
+        before = fh.read()
+
+    # conditional PUT: an existing digest is not clobbered
+    indexer._put_digest(digest_file, "clobber")
+
+    with s3_fs.open(digest_file) as fh:
+        assert fh.read() == before
+
+
+def test_flush_digests_dry_run():
+    indexer = S3Indexer(dry_run=True)
+
+    indexer.flush_digests()  # nothing pending: no-op
+
+    indexer._pending_digest_writes.append(("bucket/file.whl.sha256sum", "digest"))
+    indexer.flush_digests()
+    assert not indexer._pending_digest_writes
+
+
+def test_write_index_skip_unchanged(indexer, monkeypatch):
+    indexer.write_index(contents="same")
+
+    calls = []
+    client = indexer._s3
+    original = client.put_object
+    monkeypatch.setattr(
+        client,
+        "put_object",
+        lambda **kwargs: calls.append(kwargs) or original(**kwargs),
+    )
+
+    indexer.write_index(contents="same")
+    assert not calls
+
+    indexer.write_index(contents="different")
+    assert len(calls) == 1
+
+
+def test_write_index_logs_failures(indexer, monkeypatch):
+    def broken_put_object(**kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(indexer, "_index_changed", lambda key, body: True)
+    monkeypatch.setattr(indexer._s3, "put_object", broken_put_object)
+
+    # errors are logged, not raised
+    indexer.write_index(contents="dummy")
+
+
+def test_run_dry_run(tmp_path, monkeypatch, mocked_wheels_bucket, s3_fs, bucket_name):
+    monkeypatch.chdir(tmp_path)
+    indexer = S3Indexer(bucket_name=bucket_name, dry_run=True)
+    indexer.fs = s3_fs
+    indexer.list_ttl = 0
+
+    indexer.run()
+
+    index = (tmp_path / "index_test" / indexer.module_name / "index.html").read_text()
+    assert "https://vllm-wheels.s3.us-west-2.amazonaws.com/" in index
+
+
+def test_json_helpers_without_orjson(monkeypatch):
+    monkeypatch.setattr(generate_index, "orjson", None)
+    data = [{"Key": "a/b.whl", "ETag": "etag"}]
+    assert generate_index._json_loads(generate_index._json_dumps(data)) == data
+
+
+def test_generate_index_skips_unparseable_paths(indexer, s3_fs, bucket_name):
+    indexer.with_digests = False
+    with s3_fs.open(f"{bucket_name}/toplevel.whl", "w") as fh:
+        fh.write("stray")
+
+    index, _, _ = indexer.generate_index()
+    assert "toplevel.whl" not in index